@@ -1,10 +1,17 @@
+import bisect
 import codecs
 from collections.abc import MutableMapping
+import hashlib
+from io import UnsupportedOperation
 import logging
+import mmap
 import os
 import pickle
 import shutil
+import struct
 import tempfile
+import time
+import uuid
 
 import platformdirs
 
@@ -12,6 +19,27 @@ from .posixemulation import rename
 
 logger = logging.getLogger(__name__)
 
+# Names inside a cache directory that are never hex-encoded keys.
+_RESERVED_FILENAMES = ("blobs", "frozen")
+
+# How long a temporary file in the blobs directory must go unchanged before
+# FileCache.collect() treats it as left behind by a crashed process.
+_STALE_TMP_SECONDS = 60 * 60
+
+# Layout of a frozen cache file: a header, the records sorted by encoded key,
+# an open-addressing hash table of slots pointing at records, then the record
+# offsets in key order.
+_FROZEN_MAGIC = b"fcache\x00\x01"
+_FROZEN_HEADER = struct.Struct("<8sQQQ")  # magic, counts, slot table offset
+_FROZEN_SLOT = struct.Struct("<QQ")  # key hash, record offset (0 if empty)
+_FROZEN_INDEX = struct.Struct("<Q")  # record offset
+_FROZEN_RECORD = struct.Struct("<QQ")  # key length, value length
+
+
+def _frozen_hash(bkey):
+    """Return a process-independent 64-bit hash of bkey."""
+    return int.from_bytes(hashlib.blake2b(bkey, digest_size=8).digest(), "little")
+
 
 class FileCache(MutableMapping):
     """A persistent file cache that is dictionary-like and has a write buffer.
@@ -41,6 +69,8 @@ class FileCache(MutableMapping):
         cache is used with a :class:`~shelve.Shelf`, set this to ``False``.
     :param str app_cache_dir: absolute path to root cache directory to be
         used in place of system-appropriate location determined by platformdirs
+    :param bool dedupe: Whether or not to store values by content hash. See
+        below for details.
 
     The optional *flag* argument can be:
 
@@ -59,6 +89,13 @@ class FileCache(MutableMapping):
     |         | for reading and writing                   |
     +---------+-------------------------------------------+
 
+    If the cache has been frozen with :meth:`freeze`, opening it with ``'r'``
+    maps the frozen file into memory instead of reading the cache directory.
+    Writing to or deleting from the cache removes the frozen file, so later
+    ``'r'`` opens read the cache directory until :meth:`freeze` is called
+    again. Caches already opened with ``'r'`` keep reading the frozen file
+    they mapped.
+
     If a ``'s'`` is appended to the *flag* argument, the cache will be opened
     in sync mode. Writing to the cache will happen immediately and will not be
     buffered.
@@ -76,6 +113,16 @@ class FileCache(MutableMapping):
     :meth:`delete` on an application's main cache will not delete data in
     its subcaches.
 
+    If *dedupe* is ``True``, each serialized value is stored once in a blob
+    file named after its SHA-256 digest and every key's cache file is a hard
+    link to that blob. Keys with byte-identical values share a single blob,
+    and writing a value that is already stored under a key skips the disk
+    write entirely. A blob is removed once no key refers to it anymore. The
+    cache directory must be on a filesystem that supports hard links. Once a
+    cache has stored a blob, it is always opened in dedupe mode, whatever
+    *dedupe* is set to. Blobs and temporary files left behind by a process
+    that crashed while writing are removed by :meth:`collect`.
+
     """
 
     def __init__(
@@ -86,6 +133,7 @@ class FileCache(MutableMapping):
         keyencoding="utf-8",
         serialize=True,
         app_cache_dir=None,
+        dedupe=False,
     ):
         """Initialize a :class:`FileCache` object."""
         if not isinstance(flag, str):
@@ -109,6 +157,11 @@ class FileCache(MutableMapping):
             app_cache_dir = platformdirs.user_cache_dir(appname, appname)
         subcache_dir = os.path.join(app_cache_dir, *subcache)
         self.cache_dir = os.path.join(subcache_dir, "cache")
+        self._blob_dir = os.path.join(self.cache_dir, "blobs")
+        self._frozen_filename = os.path.join(self.cache_dir, "frozen")
+        self._frozen = None
+        self._key_index = None
+        self._dedupe = dedupe
         exists = os.path.exists(self.cache_dir)
 
         if len(flag) > 1 and flag[1] == "s":
@@ -124,8 +177,12 @@ class FileCache(MutableMapping):
             self.create()
         elif not exists:
             raise FileNotFoundError("no such directory: '{}'".format(self.cache_dir))
+        if os.path.isdir(self._blob_dir):
+            self._dedupe = True
 
         self._flag = "rb" if "r" in flag else "wb"
+        if "r" in flag:
+            self._open_frozen()
         self._mode = mode
         self._keyencoding = keyencoding
         self._serialize = serialize
@@ -140,6 +197,8 @@ class FileCache(MutableMapping):
         if not self._sync and not hasattr(self, "_buffer"):
             self._buffer = {}
         os.makedirs(self.cache_dir, exist_ok=True)
+        if self._dedupe:
+            os.makedirs(self._blob_dir, exist_ok=True)
 
     def clear(self):
         """Remove all items from the write buffer and cache.
@@ -154,6 +213,8 @@ class FileCache(MutableMapping):
         """Delete the write buffer and cache directory."""
         if not self._sync:
             del self._buffer
+        self._close_frozen()
+        self._key_index = None
 
         # Allow multiple processes to delete() at the same time,
         # meaning some or all of cache_dir may already be deleted
@@ -171,7 +232,10 @@ class FileCache(MutableMapping):
 
         """
         self.sync()
-        self.sync = self.create = self.delete = self._closed
+        self._close_frozen()
+        self.sync = self.create = self.delete = self.freeze = self._closed
+        self.collect = self._closed
+        self.keys = self.items = self.delete_prefix = self._closed
         self._write_to_file = self._read_to_file = self._closed
         self._key_to_filename = self._filename_to_key = self._closed
         self.__getitem__ = self.__setitem__ = self.__delitem__ = self._closed
@@ -192,6 +256,296 @@ class FileCache(MutableMapping):
         self._buffer.clear()
         self._sync = False
 
+    def freeze(self):
+        """Sync the write buffer, then write the cache to a single frozen file.
+
+        The frozen file holds every key and value in the cache along with a
+        hash index, and is used when the cache is later opened with the
+        ``'r'`` *flag* argument. Calling :meth:`freeze` again replaces it.
+
+        """
+        if self._flag == "rb":
+            raise UnsupportedOperation("cache opened for reading only")
+        self.sync()
+        records = sorted(
+            (self._filename_to_key(fn).encode(self._keyencoding), fn)
+            for fn in self._all_filenames()
+        )
+        hashes, offsets = [], []
+        offset = _FROZEN_HEADER.size
+        fh, tmp = tempfile.mkstemp()
+        try:
+            with os.fdopen(fh, self._flag) as f:
+                f.seek(offset)
+                for bkey, filename in records:
+                    try:
+                        with open(filename, "rb") as vf:
+                            value = vf.read()
+                    except FileNotFoundError:
+                        continue  # deleted by another process
+                    f.write(_FROZEN_RECORD.pack(len(bkey), len(value)))
+                    f.write(bkey)
+                    f.write(value)
+                    hashes.append(_frozen_hash(bkey))
+                    offsets.append(offset)
+                    offset += _FROZEN_RECORD.size + len(bkey) + len(value)
+                nslots = max(1, 2 * len(offsets))
+                slots = [(0, 0)] * nslots
+                for h, record in zip(hashes, offsets):
+                    i = h % nslots
+                    while slots[i][1]:
+                        i = (i + 1) % nslots
+                    slots[i] = (h, record)
+                for slot in slots:
+                    f.write(_FROZEN_SLOT.pack(*slot))
+                for record in offsets:
+                    f.write(_FROZEN_INDEX.pack(record))
+                f.seek(0)
+                f.write(
+                    _FROZEN_HEADER.pack(_FROZEN_MAGIC, len(offsets), nslots, offset)
+                )
+        except BaseException:
+            os.remove(tmp)
+            raise
+        rename(tmp, self._frozen_filename)
+        if self._mode:
+            os.chmod(self._frozen_filename, self._mode)
+
+    def _open_frozen(self):
+        """Map the frozen cache file into memory if it exists."""
+        invalid = ValueError(
+            "invalid frozen cache file: '{}'".format(self._frozen_filename)
+        )
+        try:
+            with open(self._frozen_filename, "rb") as f:
+                frozen = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return
+        except ValueError:  # the file is empty
+            raise invalid from None
+        if len(frozen) < _FROZEN_HEADER.size:
+            frozen.close()
+            raise invalid
+        magic, count, nslots, table = _FROZEN_HEADER.unpack_from(frozen)
+        size = table + nslots * _FROZEN_SLOT.size + count * _FROZEN_INDEX.size
+        # The records end where the slot table starts, so the last record
+        # must end there too.
+        records_end = _FROZEN_HEADER.size
+        if count and len(frozen) == size:
+            (offset,) = _FROZEN_INDEX.unpack_from(frozen, size - _FROZEN_INDEX.size)
+            if _FROZEN_HEADER.size <= offset <= table - _FROZEN_RECORD.size:
+                klen, vlen = _FROZEN_RECORD.unpack_from(frozen, offset)
+                records_end = offset + _FROZEN_RECORD.size + klen + vlen
+            else:
+                records_end = -1
+        if (
+            magic != _FROZEN_MAGIC
+            or nslots <= count
+            or len(frozen) != size
+            or records_end != table
+        ):
+            frozen.close()
+            raise invalid
+        self._frozen_count, self._frozen_slots = count, nslots
+        self._frozen_table = table
+        self._frozen = frozen
+
+    def _remove_frozen(self):
+        """Remove the frozen file, which no longer matches the cache files."""
+        try:
+            os.remove(self._frozen_filename)
+        except FileNotFoundError:
+            pass
+
+    def _close_frozen(self):
+        """Unmap the frozen cache file if it is open."""
+        if self._frozen is not None:
+            self._frozen.close()
+            self._frozen = None
+
+    def _frozen_lookup(self, ekey):
+        """Return the serialized value for ekey in the frozen file or None."""
+        bkey = ekey.encode(self._keyencoding)
+        h = _frozen_hash(bkey)
+        i = h % self._frozen_slots
+        while True:
+            slot_hash, offset = _FROZEN_SLOT.unpack_from(
+                self._frozen, self._frozen_table + i * _FROZEN_SLOT.size
+            )
+            if not offset:
+                return None
+            if slot_hash == h:
+                klen, vlen = _FROZEN_RECORD.unpack_from(self._frozen, offset)
+                start = offset + _FROZEN_RECORD.size
+                if self._frozen[start : start + klen] == bkey:
+                    return self._frozen[start + klen : start + klen + vlen]
+            i = (i + 1) % self._frozen_slots
+
+    def _frozen_key_at(self, i):
+        """Return the i-th encoded key, in sorted order, of the frozen file."""
+        (offset,) = _FROZEN_INDEX.unpack_from(
+            self._frozen,
+            self._frozen_table
+            + self._frozen_slots * _FROZEN_SLOT.size
+            + i * _FROZEN_INDEX.size,
+        )
+        klen, _ = _FROZEN_RECORD.unpack_from(self._frozen, offset)
+        start = offset + _FROZEN_RECORD.size
+        return self._frozen[start : start + klen].decode(self._keyencoding)
+
+    def _frozen_keys(self, eprefix=""):
+        """Return a sorted list of encoded key names in the frozen file.
+
+        Only keys starting with *eprefix* are returned. The first match is
+        found with a binary search over the frozen file's key order.
+
+        """
+        lo, hi = 0, self._frozen_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._frozen_key_at(mid) < eprefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        keys = []
+        for i in range(lo, self._frozen_count):
+            key = self._frozen_key_at(i)
+            if not key.startswith(eprefix):
+                break
+            keys.append(key)
+        return keys
+
+    def keys(self, prefix=None):
+        """Return the cache's keys.
+
+        If *prefix* is given, a sorted list of only the keys starting with
+        *prefix* is returned. Otherwise, a view of all keys is returned, as
+        with :meth:`dict.keys`.
+
+        Prefix scans use a sorted index of the cache files that is kept up
+        to date as this object writes and deletes keys. If another process
+        changes the cache, the next scan rebuilds the index from a full
+        listing of the cache directory. A change that another process makes
+        while this object is writing or deleting a key is missed, and prefix
+        scans do not include it until the cache directory is changed by
+        another process again.
+
+        """
+        if prefix is None:
+            return super().keys()
+        return [self._decode_key(ekey) for ekey in self._prefix_keys(prefix)]
+
+    def items(self, prefix=None):
+        """Return the cache's items (``(key, value)`` pairs).
+
+        If *prefix* is given, a sorted list of only the items whose keys
+        start with *prefix* is returned. Otherwise, a view of all items is
+        returned, as with :meth:`dict.items`.
+
+        """
+        if prefix is None:
+            return super().items()
+        items = []
+        for ekey in self._prefix_keys(prefix):
+            if not self._sync and ekey in self._buffer:
+                value = self._buffer[ekey]
+            elif self._frozen is not None:
+                value = self._loads(self._frozen_lookup(ekey))
+            else:
+                try:
+                    value = self._read_from_file(self._key_to_filename(ekey))
+                except FileNotFoundError:
+                    continue  # deleted by another process
+            items.append((self._decode_key(ekey), value))
+        return items
+
+    def delete_prefix(self, prefix):
+        """Remove all items whose keys start with *prefix*.
+
+        Returns the number of items removed.
+
+        """
+        ekeys = self._prefix_keys(prefix)
+        if self._frozen is not None:
+            for ekey in ekeys:
+                if self._frozen_lookup(ekey) is not None:
+                    raise UnsupportedOperation("cache opened for reading only")
+        removed = 0
+        for ekey in ekeys:
+            found = not self._sync and ekey in self._buffer
+            if found:
+                del self._buffer[ekey]
+            if self._frozen is None:
+                try:
+                    self._remove_file(self._key_to_filename(ekey))
+                    found = True
+                except FileNotFoundError:
+                    pass  # deleted by another process
+            if found:
+                removed += 1
+        return removed
+
+    def _prefix_keys(self, prefix):
+        """Return a sorted list of encoded key names starting with prefix."""
+        eprefix = self._encode_key(prefix)
+        if self._frozen is not None:
+            file_keys = self._frozen_keys(eprefix)
+        else:
+            index = self._sorted_file_keys()
+            file_keys = []
+            for i in range(bisect.bisect_left(index, eprefix), len(index)):
+                if not index[i].startswith(eprefix):
+                    break
+                file_keys.append(index[i])
+        if self._sync:
+            return file_keys
+        buffer_keys = [ekey for ekey in self._buffer if ekey.startswith(eprefix)]
+        return sorted(set(file_keys).union(buffer_keys))
+
+    def _sorted_file_keys(self):
+        """Return a sorted list of the encoded key names of the cache files.
+
+        The list is kept between calls along with the cache directory's
+        modification time. Writes and deletes made by this object update it
+        in place and record the new modification time, which also hides any
+        change another process made during that write or delete. A
+        modification time that changes between this object's own changes
+        means another process changed the cache, and the list is rebuilt.
+        On filesystems with coarse timestamps, a change made by another
+        process in the same tick as the listing is also missed until the
+        directory changes again.
+
+        """
+        try:
+            mtime = os.stat(self.cache_dir).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        if self._key_index is not None and self._key_index[0] == mtime:
+            return self._key_index[1]
+        keys = sorted(self._filename_to_key(fn) for fn in self._all_filenames())
+        self._key_index = (mtime, keys)
+        return keys
+
+    def _current_key_index(self):
+        """Return the sorted key index if no other process has changed it."""
+        if self._key_index is None:
+            return None
+        try:
+            mtime = os.stat(self.cache_dir).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._key_index[0]:
+            self._key_index = None
+            return None
+        return self._key_index[1]
+
+    def _store_key_index(self, keys):
+        """Keep keys as the sorted key index after this object changed it."""
+        try:
+            self._key_index = (os.stat(self.cache_dir).st_mtime_ns, keys)
+        except FileNotFoundError:
+            self._key_index = None
+
     def _closed(self, *args, **kwargs):
         """Filler method for closed cache methods."""
         raise ValueError("invalid operation on closed cache")
@@ -239,13 +593,17 @@ class FileCache(MutableMapping):
             return [
                 os.path.join(self.cache_dir, filename)
                 for filename in os.listdir(self.cache_dir)
+                if filename not in _RESERVED_FILENAMES
             ]
         except (FileNotFoundError, OSError):
             return []
 
     def _all_keys(self):
         """Return a list of all encoded key names."""
-        file_keys = [self._filename_to_key(fn) for fn in self._all_filenames()]
+        if self._frozen is not None:
+            file_keys = self._frozen_keys()
+        else:
+            file_keys = [self._filename_to_key(fn) for fn in self._all_filenames()]
         if self._sync:
             return set(file_keys)
         else:
@@ -253,12 +611,121 @@ class FileCache(MutableMapping):
 
     def _write_to_file(self, filename, bytesvalue):
         """Write bytesvalue to filename."""
-        fh, tmp = tempfile.mkstemp()
-        with os.fdopen(fh, self._flag) as f:
-            f.write(self._dumps(bytesvalue))
+        if self._flag == "rb":
+            raise UnsupportedOperation("cache opened for reading only")
+        index = self._current_key_index()
+        self._remove_frozen()
+        if self._dedupe:
+            self._link_to_blob(filename, self._dumps(bytesvalue))
+        else:
+            fh, tmp = tempfile.mkstemp()
+            with os.fdopen(fh, self._flag) as f:
+                f.write(self._dumps(bytesvalue))
+            rename(tmp, filename)
+            if self._mode:
+                os.chmod(filename, self._mode)
+        if index is not None:
+            ekey = self._filename_to_key(filename)
+            i = bisect.bisect_left(index, ekey)
+            if index[i : i + 1] != [ekey]:
+                index.insert(i, ekey)
+            self._store_key_index(index)
+
+    def _remove_file(self, filename):
+        """Remove a cache file, and its blob if no other key refers to it."""
+        index = self._current_key_index()
+        blob = self._blob_for_file(filename) if self._dedupe else None
+        if os.path.lexists(filename):
+            self._remove_frozen()
+        os.remove(filename)
+        if blob is not None:
+            self._collect_blob(blob)
+        if index is not None:
+            ekey = self._filename_to_key(filename)
+            i = bisect.bisect_left(index, ekey)
+            if index[i : i + 1] == [ekey]:
+                del index[i]
+            self._store_key_index(index)
+
+    def collect(self):
+        """Remove unreferenced blobs and stale temporary files.
+
+        Blobs are normally removed as soon as no key refers to them, so this
+        only needs to be called to clean up after a process that crashed
+        while writing to a cache opened with *dedupe*.
+
+        """
+        try:
+            names = os.listdir(self._blob_dir)
+        except FileNotFoundError:
+            return
+        now = time.time()
+        for name in names:
+            path = os.path.join(self._blob_dir, name)
+            if not name.startswith("tmp"):
+                self._collect_blob(path)
+                continue
+            try:
+                if now - os.stat(path).st_ctime > _STALE_TMP_SECONDS:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _blob_filename(self, data):
+        """Return the absolute blob filename for serialized data."""
+        return os.path.join(self._blob_dir, hashlib.sha256(data).hexdigest())
+
+    def _link_to_blob(self, filename, data):
+        """Point filename at the blob holding data, writing it if needed.
+
+        Nothing is written if filename is already a link to that blob.
+
+        """
+        blob = self._blob_filename(data)
+        try:
+            if os.path.samefile(filename, blob):
+                return
+        except FileNotFoundError:
+            pass
+        try:
+            old_blob = self._blob_for_file(filename)
+        except FileNotFoundError:
+            old_blob = None
+        tmp = os.path.join(self._blob_dir, "tmp" + uuid.uuid4().hex)
+        # Another process may collect the blob between writing and linking
+        # it, in which case it is written again.
+        while True:
+            try:
+                os.link(blob, tmp)
+                break
+            except FileNotFoundError:
+                self._write_blob(blob, data)
         rename(tmp, filename)
+        if old_blob is not None and old_blob != blob:
+            self._collect_blob(old_blob)
+
+    def _write_blob(self, blob, data):
+        """Write data to the blob filename."""
+        os.makedirs(self._blob_dir, exist_ok=True)
+        fh, tmp = tempfile.mkstemp(dir=self._blob_dir, prefix="tmp")
+        with os.fdopen(fh, self._flag) as f:
+            f.write(data)
+        rename(tmp, blob)
         if self._mode:
-            os.chmod(filename, self._mode)
+            os.chmod(blob, self._mode)
+
+    def _blob_for_file(self, filename):
+        """Return the blob filename that a cache file is linked to."""
+        with open(filename, "rb") as f:
+            return self._blob_filename(f.read())
+
+    def _collect_blob(self, blob):
+        """Remove blob if no cache file links to it anymore."""
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
 
     def _read_from_file(self, filename):
         """Read data from filename."""
@@ -280,6 +747,11 @@ class FileCache(MutableMapping):
                 return self._buffer[ekey]
             except KeyError:
                 pass
+        if self._frozen is not None:
+            value = self._frozen_lookup(ekey)
+            if value is None:
+                raise KeyError(key)
+            return self._loads(value)
         filename = self._key_to_filename(ekey)
         if filename not in self._all_filenames():
             raise KeyError(key)
@@ -287,27 +759,44 @@ class FileCache(MutableMapping):
 
     def __delitem__(self, key):
         ekey = self._encode_key(key)
+        if self._frozen is not None and self._frozen_lookup(ekey) is not None:
+            raise UnsupportedOperation("cache opened for reading only")
         found_in_buffer = hasattr(self, "_buffer") and ekey in self._buffer
         if not self._sync:
             try:
                 del self._buffer[ekey]
             except KeyError:
                 pass
-        filename = self._key_to_filename(ekey)
-        if filename in self._all_filenames():
-            os.remove(filename)
-        elif not found_in_buffer:
-            raise KeyError(key)
+        if self._frozen is not None:
+            if not found_in_buffer:
+                raise KeyError(key)
+            return
+        try:
+            self._remove_file(self._key_to_filename(ekey))
+        except FileNotFoundError:
+            if not found_in_buffer:
+                raise KeyError(key)
 
     def __iter__(self):
         for key in self._all_keys():
             yield self._decode_key(key)
 
     def __len__(self):
+        if self._frozen is not None:
+            if self._sync:
+                return self._frozen_count
+            unfrozen = [
+                ekey for ekey in self._buffer if self._frozen_lookup(ekey) is None
+            ]
+            return self._frozen_count + len(unfrozen)
         return len(self._all_keys())
 
     def __contains__(self, key):
         ekey = self._encode_key(key)
+        if self._frozen is not None:
+            if not self._sync and ekey in self._buffer:
+                return True
+            return self._frozen_lookup(ekey) is not None
         return ekey in self._all_keys()
 
     def __enter__(self):
@@ -3,6 +3,7 @@ from io import UnsupportedOperation
 import os
 import shelve
 import unittest
+import unittest.mock
 
 import fcache.cache
 
@@ -85,6 +86,7 @@ class TestFileCache(unittest.TestCase):
         self.cache.close()
         self.assertRaises(ValueError, self.cache.create)
         self.assertRaises(ValueError, self.cache.sync)
+        self.assertRaises(ValueError, self.cache.freeze)
         self.assertRaises(ValueError, self.cache.delete)
         self.assertRaises(ValueError, self.cache.close)
         self.assertRaises(ValueError, self.cache.clear)
@@ -223,6 +225,283 @@ class TestFileCache(unittest.TestCase):
             statinfo = os.stat(filename)
             self.assertEqual(oct(statinfo.st_mode & 0o777), "0o600")
 
+    def test_dedupe(self):
+        self.cache.delete()
+        self.cache = fcache.cache.FileCache(self.appname, dedupe=True)
+        self.cache["foo"] = b"value"
+        self.cache["bar"] = b"value"
+        self.cache["baz"] = b"other"
+        self.cache.sync()
+        foo = self.cache._key_to_filename(self.cache._encode_key("foo"))
+        bar = self.cache._key_to_filename(self.cache._encode_key("bar"))
+        self.assertTrue(os.path.samefile(foo, bar))
+        self.assertEqual(len(os.listdir(self.cache._blob_dir)), 2)
+        self.assertEqual(sorted(self.cache), ["bar", "baz", "foo"])
+        self.assertEqual(self.cache["foo"], b"value")
+
+        # unchanged values are not rewritten
+        inode = os.stat(foo).st_ino
+        self.cache["foo"] = b"value"
+        self.cache.sync()
+        self.assertEqual(os.stat(foo).st_ino, inode)
+
+        # unreferenced blobs are collected
+        self.cache["baz"] = b"value"
+        self.cache.sync()
+        self.assertEqual(len(os.listdir(self.cache._blob_dir)), 1)
+        del self.cache["foo"]
+        del self.cache["bar"]
+        self.assertEqual(len(os.listdir(self.cache._blob_dir)), 1)
+        del self.cache["baz"]
+        self.assertEqual(os.listdir(self.cache._blob_dir), [])
+
+        self.cache["foo"] = b"value"
+        self.cache.sync()
+        self.cache.clear()
+        self.assertEqual(os.listdir(self.cache._blob_dir), [])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_dedupe_existing_cache(self):
+        self.cache.clear()
+        self.cache["foo"] = b"value"
+        self.cache.close()
+        self.cache = fcache.cache.FileCache(self.appname, flag="cs", dedupe=True)
+        self.cache["bar"] = b"value"
+        self.assertEqual(len(os.listdir(self.cache._blob_dir)), 1)
+        self.assertEqual(self.cache["foo"], b"value")
+        self.assertEqual(self.cache["bar"], b"value")
+
+    def test_dedupe_blob_collected_before_link(self):
+        self.cache = fcache.cache.FileCache(self.appname, flag="cs", dedupe=True)
+        write_blob = self.cache._write_blob
+
+        def collected_write_blob(blob, data):
+            # simulate another process collecting the blob the first time
+            write_blob(blob, data)
+            if not hasattr(collected_write_blob, "called"):
+                collected_write_blob.called = True
+                os.remove(blob)
+
+        self.cache._write_blob = collected_write_blob
+        self.cache["foo"] = b"value"
+        self.assertEqual(self.cache["foo"], b"value")
+        self.assertEqual(len(os.listdir(self.cache._blob_dir)), 1)
+
+    def test_dedupe_marker(self):
+        self.cache.delete()
+        self.cache = fcache.cache.FileCache(self.appname, flag="cs", dedupe=True)
+        self.cache["foo"] = b"value"
+        self.cache.close()
+        self.cache = fcache.cache.FileCache(self.appname, flag="cs")
+        self.assertTrue(self.cache._dedupe)
+        self.cache["foo"] = b"other"
+        del self.cache["foo"]
+        self.assertEqual(os.listdir(self.cache._blob_dir), [])
+
+    def test_collect(self):
+        self.cache.delete()
+        self.cache = fcache.cache.FileCache(self.appname, flag="cs", dedupe=True)
+        self.cache["foo"] = b"value"
+        self.cache.collect()
+        self.assertEqual(len(os.listdir(self.cache._blob_dir)), 1)
+
+        orphan = self.cache._blob_filename(b"orphan")
+        self.cache._write_blob(orphan, b"orphan")
+        stale = os.path.join(self.cache._blob_dir, "tmpstale")
+        open(stale, "wb").close()
+        self.cache.collect()
+        self.assertTrue(os.path.exists(stale))
+        self.assertFalse(os.path.exists(orphan))
+
+        ctime = os.stat(stale).st_ctime
+        with unittest.mock.patch("time.time", return_value=ctime + 2 * 60 * 60):
+            self.cache.collect()
+        self.assertFalse(os.path.exists(stale))
+        self.assertEqual(self.cache["foo"], b"value")
+
+    def test_freeze(self):
+        self.cache["foo"] = b"value"
+        self.cache["bar"] = [1, 2, 3]
+        self.cache.sync()
+        self.cache["baz"] = "buffered"
+        self.cache.freeze()
+        self.assertEqual(self.cache._buffer, {})
+        self.assertTrue(os.path.exists(self.cache._frozen_filename))
+        self.assertEqual(sorted(self.cache), ["bar", "baz", "foo"])
+        self.cache.close()
+
+        frozen = fcache.cache.FileCache(self.appname, flag="r")
+        self.assertIsNotNone(frozen._frozen)
+        self.assertEqual(frozen["foo"], b"value")
+        self.assertEqual(frozen["bar"], [1, 2, 3])
+        self.assertEqual(frozen["baz"], "buffered")
+        self.assertRaises(KeyError, frozen.__getitem__, "qux")
+        self.assertTrue("foo" in frozen)
+        self.assertFalse("qux" in frozen)
+        self.assertEqual(len(frozen), 3)
+        self.assertEqual(sorted(frozen), ["bar", "baz", "foo"])
+        self.assertRaises(UnsupportedOperation, frozen.__delitem__, "foo")
+        self.assertRaises(KeyError, frozen.__delitem__, "qux")
+        frozen["qux"] = b"buffered"
+        frozen["foo"] = b"buffered"
+        self.assertEqual(len(frozen), 4)
+        frozen._buffer.clear()
+        frozen.close()
+        self.assertIsNone(frozen._frozen)
+
+        # writes remove the frozen file, so it is never served out of date
+        self.cache = fcache.cache.FileCache(self.appname)
+        self.assertIsNone(self.cache._frozen)
+        self.cache["qux"] = b"not frozen"
+        self.cache.sync()
+        self.assertFalse(os.path.exists(self.cache._frozen_filename))
+        frozen = fcache.cache.FileCache(self.appname, flag="r")
+        self.assertIsNone(frozen._frozen)
+        self.assertEqual(frozen["qux"], b"not frozen")
+        self.assertEqual(len(frozen), 4)
+        frozen.close()
+
+        self.cache.freeze()
+        self.assertRaises(KeyError, self.cache.__delitem__, "nope")
+        self.assertTrue(os.path.exists(self.cache._frozen_filename))
+        del self.cache["qux"]
+        self.assertFalse(os.path.exists(self.cache._frozen_filename))
+        self.assertEqual(len(self.cache), 3)
+        self.cache.clear()
+        self.cache.freeze()
+        frozen = fcache.cache.FileCache(self.appname, flag="r")
+        self.assertEqual(len(frozen), 0)
+        self.assertFalse("foo" in frozen)
+        frozen.close()
+
+    def test_freeze_errors(self):
+        self.cache.clear()
+        self.cache["foo"] = b"value"
+        mkstemp = fcache.cache.tempfile.mkstemp
+        tmps = []
+
+        def recording_mkstemp(*args, **kwargs):
+            fh, tmp = mkstemp(*args, **kwargs)
+            tmps.append(tmp)
+            return fh, tmp
+
+        with (
+            unittest.mock.patch.object(
+                fcache.cache.tempfile, "mkstemp", recording_mkstemp
+            ),
+            unittest.mock.patch.object(
+                fcache.cache, "_frozen_hash", side_effect=OverflowError
+            ),
+        ):
+            self.assertRaises(OverflowError, self.cache.freeze)
+        self.assertFalse(os.path.exists(tmps[-1]))
+        self.assertFalse(os.path.exists(self.cache._frozen_filename))
+
+        # keys deleted by another process while freezing are skipped
+        missing = self.cache._key_to_filename(self.cache._encode_key("gone"))
+        all_filenames = self.cache._all_filenames
+        with unittest.mock.patch.object(
+            self.cache,
+            "_all_filenames",
+            side_effect=lambda: all_filenames() + [missing],
+        ):
+            self.cache.freeze()
+        frozen = fcache.cache.FileCache(self.appname, flag="r")
+        self.assertEqual(frozen.keys(""), ["foo"])
+        self.assertEqual(len(frozen), 1)
+        frozen.close()
+
+        self.cache.freeze()
+        self.cache.close()
+        self.cache = fcache.cache.FileCache(self.appname, flag="r")
+        self.cache["bar"] = b"buffered"
+        self.assertRaises(UnsupportedOperation, self.cache.freeze)
+        self.assertRaises(UnsupportedOperation, self.cache.__delitem__, "foo")
+        self.cache["foo"] = b"buffered"
+        self.assertRaises(UnsupportedOperation, self.cache.__delitem__, "foo")
+        self.assertEqual(self.cache["foo"], b"buffered")
+        del self.cache["bar"]
+        self.cache._buffer.clear()
+        self.cache.close()
+
+        with open(self.cache._frozen_filename, "rb") as f:
+            data = f.read()
+        for truncated in (b"", data[:10], data[:-1]):
+            with open(self.cache._frozen_filename, "wb") as f:
+                f.write(truncated)
+            self.assertRaises(
+                ValueError, fcache.cache.FileCache, self.appname, flag="r"
+            )
+
+    def test_prefix(self):
+        self.cache.clear()
+        self.cache["user:1:name"] = b"a"
+        self.cache["user:1:mail"] = b"b"
+        self.cache["user:12:name"] = b"c"
+        self.cache.sync()
+        self.cache["user:1:zip"] = b"d"
+        self.cache["other"] = b"e"
+        self.assertEqual(
+            self.cache.keys("user:1:"), ["user:1:mail", "user:1:name", "user:1:zip"]
+        )
+        self.assertEqual(self.cache.items(prefix="user:12"), [("user:12:name", b"c")])
+        self.assertEqual(self.cache.keys("nope"), [])
+        self.assertEqual(len(self.cache.keys("")), 5)
+        self.assertEqual(sorted(self.cache.keys()), sorted(self.cache.keys("")))
+
+        self.assertEqual(self.cache.delete_prefix("user:1:"), 3)
+        self.assertEqual(sorted(self.cache), ["other", "user:12:name"])
+        self.assertEqual(self.cache.keys("user:1:"), [])
+
+        self.cache.freeze()
+        self.cache.close()
+        frozen = fcache.cache.FileCache(self.appname, flag="r")
+        self.assertEqual(frozen.keys("user:"), ["user:12:name"])
+        self.assertEqual(frozen.items("oth"), [("other", b"e")])
+        self.assertEqual(frozen.keys("zzz"), [])
+        frozen["user:9"] = b"buffered"
+        self.assertEqual(frozen.delete_prefix("user:9"), 1)
+        self.assertRaises(UnsupportedOperation, frozen.delete_prefix, "user:")
+        self.assertEqual(frozen.delete_prefix("zzz"), 0)
+        frozen.close()
+
+    def test_delete_prefix_frozen_empty_values(self):
+        self.cache.close()
+        self.cache = fcache.cache.FileCache(self.appname, flag="n", serialize=False)
+        self.cache["a:1"] = b""
+        self.cache["a:2"] = b""
+        self.cache.freeze()
+        self.cache.close()
+        frozen = fcache.cache.FileCache(self.appname, flag="r", serialize=False)
+        self.assertRaises(UnsupportedOperation, frozen.delete_prefix, "a:")
+        self.assertEqual(frozen.keys("a:"), [b"a:1", b"a:2"])
+        self.assertEqual(len(frozen), 2)
+        frozen.close()
+
+    def test_sorted_file_keys(self):
+        self.cache.clear()
+        self.cache["a"] = b"1"
+        self.cache.sync()
+        self.assertEqual(self.cache._sorted_file_keys(), ["61"])
+
+        # writes and deletes by this object update the index in place
+        with unittest.mock.patch("os.listdir") as listdir:
+            self.cache["c"] = b"3"
+            self.cache["b"] = b"2"
+            self.cache.sync()
+            self.assertEqual(self.cache._sorted_file_keys(), ["61", "62", "63"])
+            self.assertEqual(self.cache.delete_prefix("c"), 1)
+            self.assertEqual(self.cache.items("b"), [("b", b"2")])
+            self.assertEqual(self.cache._sorted_file_keys(), ["61", "62"])
+            listdir.assert_not_called()
+
+        # changes made by another process rebuild the index
+        other = fcache.cache.FileCache(self.appname, flag="cs")
+        mtime = os.stat(self.cache.cache_dir).st_mtime_ns - 10**9
+        os.utime(self.cache.cache_dir, ns=(mtime, mtime))
+        other["d"] = b"4"
+        self.assertEqual(self.cache._sorted_file_keys(), ["61", "62", "64"])
+
 
 class TestShelfCache(unittest.TestCase):
     def setUp(self):